@@ -1,5 +1,4 @@
 import streamlit as st
-import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import logic
@@ -11,6 +10,9 @@ st.set_page_config(
     layout="wide"
 )
 
+# Max points per background trace sent to the browser
+MAX_BG_POINTS = 1000
+
 # --- Language Settings ---
 if 'lang' not in st.session_state:
     st.session_state.lang = 'ja'
@@ -167,10 +169,6 @@ if df.empty:
     st.error("Failed to load data.")
     st.stop()
 
-# Create Date column for better plotting (Global)
-df['Day'] = 1
-df['Date'] = pd.to_datetime(df[['Year', 'Month', 'Day']])
-
 # Search Logic
 if run_search:
     results = logic.search_analog_years(
@@ -229,10 +227,15 @@ if run_search:
         fig = make_subplots(rows=len(plot_cols), cols=1, shared_xaxes=True, 
                             subplot_titles=plot_cols)
         
+        # Build all traces first and add them in one pass
+        traces, rows = [], []
+
         # Full Time Series (Background)
         for i, col in enumerate(plot_cols):
-            fig.add_trace(go.Scatter(x=df['Date'], y=df[col], 
-                                     mode='lines', name=col, line=dict(color='gray', width=1), opacity=0.3), row=i+1, col=1)
+            bg_x, bg_y = logic.downsample_minmax(df['Date'].to_numpy(), df[col].to_numpy(), MAX_BG_POINTS)
+            traces.append(go.Scattergl(x=bg_x, y=bg_y, 
+                                       mode='lines', name=col, line=dict(color='gray', width=1), opacity=0.3))
+            rows.append(i+1)
         
         # Highlight Analog Years
         analog_years = results['Year'].tolist()
@@ -240,15 +243,21 @@ if run_search:
         import plotly.colors
         colors = plotly.colors.qualitative.Plotly + plotly.colors.qualitative.D3
         
+        # Group once so each analog year is a dict lookup instead of a full scan
+        year_groups = {y: g for y, g in df.groupby('Year', sort=False)}
+        
         for i, year in enumerate(analog_years):
             # Get data for that specific year
-            year_data = df[df['Year'] == year]
+            year_data = year_groups[year]
             color = colors[i % len(colors)]
             label = f"{year} (Rank {i+1})"
             
             for j, col in enumerate(plot_cols):
-                fig.add_trace(go.Scatter(x=year_data['Date'], y=year_data[col],
-                                         mode='lines+markers', name=f"{col} {label}", line=dict(color=color, width=2), showlegend=(j==0)), row=j+1, col=1)
+                traces.append(go.Scattergl(x=year_data['Date'], y=year_data[col],
+                                           mode='lines+markers', name=f"{col} {label}", line=dict(color=color, width=2), showlegend=(j==0)))
+                rows.append(j+1)
+
+        fig.add_traces(traces, rows=rows, cols=[1] * len(traces))
 
         fig.update_layout(
             height=250 * len(plot_cols), 
@@ -271,15 +280,14 @@ else:
     # Show simple preview graph
     # Show simple preview graph
     # Default indices to show if available
-    default_show = ['ONI', 'IOD', 'PDO', 'NinoWest', 'NAO', 'PNA', 'AO', 'QBO30', 'QBO50']
-    avail_show = [c for c in default_show if c in df.columns]
+    avail_show = [c for c in logic.INDEX_COLS if c in df.columns]
     
     if avail_show:
         fig = make_subplots(rows=len(avail_show), cols=1, shared_xaxes=True, subplot_titles=avail_show)
         recent_df = df[df['Year'] >= 2000]
         
-        for i, col in enumerate(avail_show):
-            fig.add_trace(go.Scatter(x=recent_df['Date'], y=recent_df[col], name=col), row=i+1, col=1)
+        traces = [go.Scattergl(x=recent_df['Date'], y=recent_df[col], name=col) for col in avail_show]
+        fig.add_traces(traces, rows=list(range(1, len(avail_show) + 1)), cols=[1] * len(avail_show))
         
         fig.update_layout(
             height=200 * len(avail_show), 
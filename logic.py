@@ -1,222 +1,473 @@
+import datetime
+import functools
+import io
+import json
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import pandas as pd
 import requests
 import numpy as np
 import streamlit as st
 
-@st.cache_data(ttl=3600*24) # Cache data for 24 hours
-def get_climate_indices(start_year=1950):
+try:
+    from numba import njit
+except ImportError: # numba is optional; fall back to NumPy
+    njit = None
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+# Bump when the parsed frame format changes so stale parquet files are not reused
+CACHE_VERSION = 5
+
+
+def _cache_paths(url):
     """
-    Fetches ONI, IOD, and PDO data from NOAA/PSL text sources.
-    Returns a merged DataFrame.
+    Returns (parquet_path, meta_path) for the on-disk cache of a source URL.
     """
-    # 全データを統合する辞書: (Year, Month) -> {ONI, IOD, PDO}
-    data_map = {}
+    key = re.sub(r'[^A-Za-z0-9.]+', '_', url.split('://', 1)[-1])
+    base = os.path.join(CACHE_DIR, key)
+    return base + '.parquet', base + '.meta.json'
 
-    # --- 1. ENSO (ONI) - NOAA PSL Text Data ---
-    url_oni = "https://psl.noaa.gov/data/correlation/oni.data"
-    try:
-        resp = requests.get(url_oni)
-        lines = resp.text.splitlines()
-        for line in lines:
-            parts = line.split()
-            if parts and parts[0].isdigit() and len(parts) >= 13:
-                year = int(parts[0])
-                if year < start_year: continue
-                for m in range(1, 13):
-                    try:
-                        val = float(parts[m])
-                        if val > -90:
-                            if (year, m) not in data_map: data_map[(year, m)] = {}
-                            data_map[(year, m)]['ONI'] = val
-                    except: pass
-    except Exception as e:
-        print(f"ONI Error: {e}")
 
-    # --- 2. IOD (DMI) - NOAA PSL Text Data ---
-    url_iod = "https://psl.noaa.gov/gcos_wgsp/Timeseries/Data/dmi.had.long.data"
-    try:
-        resp = requests.get(url_iod)
-        lines = resp.text.splitlines()
-        for line in lines:
-            parts = line.split()
-            if parts and parts[0].isdigit() and len(parts) >= 13:
-                year = int(parts[0])
-                if year < start_year: continue
-                for m in range(1, 13):
-                    try:
-                        val = float(parts[m])
-                        if val > -90:
-                            if (year, m) not in data_map: data_map[(year, m)] = {}
-                            data_map[(year, m)]['IOD'] = val
-                    except: pass
-    except Exception as e:
-        print(f"IOD Error: {e}")
+@st.cache_resource
+def _session():
+    """
+    Shared HTTP session so sources on the same host reuse keep-alive connections.
+    """
+    return requests.Session()
 
-    # --- 3. PDO - NOAA NCEI Text Data ---
-    url_pdo = "https://www.ncei.noaa.gov/pub/data/cmb/ersst/v5/index/ersst.v5.pdo.dat"
-    try:
-        resp = requests.get(url_pdo)
-        lines = resp.text.splitlines()
-        for line in lines:
-            if "Year" in line: continue
-            parts = line.split()
-            if len(parts) >= 13:
-                year = int(parts[0])
-                if year < start_year: continue
-                for m in range(1, 13):
-                    try:
-                        val = float(parts[m])
-                        if val < 90:
-                            if (year, m) not in data_map: data_map[(year, m)] = {}
-                            data_map[(year, m)]['PDO'] = val
-                    except: pass
-    except Exception as e:
-        print(f"PDO Error: {e}")
 
-    # --- 4. Nino West (JMA) ---
-    url_ninowest = "https://www.data.jma.go.jp/cpd/data/elnino/index/ninowidx.html"
+def _read_cached(data_path):
+    """
+    Reads a cached parquet, returning None if it is missing or unreadable.
+    """
     try:
-        resp = requests.get(url_ninowest)
-        # Simple parsing for <pre> block
-        if "<pre>" in resp.text:
-            pre_content = resp.text.split("<pre>")[1].split("</pre>")[0]
-            lines = pre_content.strip().splitlines()
-            for line in lines:
-                parts = line.split()
-                if not parts or not parts[0].isdigit(): continue
-                year = int(parts[0])
-                if year < start_year: continue
-                # JMA table has Year then 12 months
-                for m in range(1, 13):
-                    if m <= len(parts) - 1:
-                        try:
-                            val = float(parts[m])
-                            if val < 90: # 99.9 is missing
-                                if (year, m) not in data_map: data_map[(year, m)] = {}
-                                data_map[(year, m)]['NinoWest'] = val
-                        except: pass
+        return pd.read_parquet(data_path)
     except Exception as e:
-        print(f"NinoWest Error: {e}")
+        print(f"Cache read failed for {data_path}: {e}")
+        return None
 
-    # --- 5. NAO (NOAA CPC) ---
-    url_nao = "https://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.nao.monthly.b5001.current.ascii.table"
-    try:
-        resp = requests.get(url_nao)
-        lines = resp.text.splitlines()
-        for line in lines:
-            parts = line.split()
-            if not parts or not parts[0].isdigit(): continue
-            year = int(parts[0])
-            if year < start_year: continue
-            for m in range(1, 13):
-                if m <= len(parts) - 1:
-                    try:
-                        val = float(parts[m])
-                        if (year, m) not in data_map: data_map[(year, m)] = {}
-                        data_map[(year, m)]['NAO'] = val
-                    except: pass
-    except Exception as e:
-        print(f"NAO Error: {e}")
 
-    # --- 6. PNA (NOAA CPC) ---
-    url_pna = "https://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.pna.monthly.b5001.current.ascii.table"
+def _write_atomic(path, write):
+    """
+    Calls write(file) on a temp file next to path and moves it into place, so readers never see a partial file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
     try:
-        resp = requests.get(url_pna)
-        lines = resp.text.splitlines()
-        for line in lines:
-            parts = line.split()
-            if not parts or not parts[0].isdigit(): continue
-            year = int(parts[0])
-            if year < start_year: continue
-            for m in range(1, 13):
-                if m <= len(parts) - 1:
-                    try:
-                        val = float(parts[m])
-                        if (year, m) not in data_map: data_map[(year, m)] = {}
-                        data_map[(year, m)]['PNA'] = val
-                    except: pass
-    except Exception as e:
-        print(f"PNA Error: {e}")
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
-    # --- 7. AO (NOAA CPC) ---
-    url_ao = "https://www.cpc.ncep.noaa.gov/products/precip/CWlink/daily_ao_index/monthly.ao.index.b50.current.ascii.table"
-    try:
-        resp = requests.get(url_ao)
-        lines = resp.text.splitlines()
-        for line in lines:
-            parts = line.split()
-            if not parts or not parts[0].isdigit(): continue
-            year = int(parts[0])
-            if year < start_year: continue
-            for m in range(1, 13):
-                if m <= len(parts) - 1:
-                    try:
-                        val = float(parts[m])
-                        if (year, m) not in data_map: data_map[(year, m)] = {}
-                        data_map[(year, m)]['AO'] = val
-                    except: pass
-    except Exception as e:
-        print(f"AO Error: {e}")
 
-    # --- 8. QBO (NOAA CPC) ---
-    # QBO 30hPa
-    url_qbo30 = "https://www.cpc.ncep.noaa.gov/data/indices/qbo.u30.index"
+def fetch_cached(url, parser, session=requests):
+    """
+    Fetches url and parses it with parser(byte_lines) -> DataFrame, caching the result on disk.
+    Sources already fetched today are served from disk without a request; otherwise a
+    conditional request (ETag / Last-Modified) is sent and a 304 reuses the cached parquet.
+    If the request fails, or the response parses to nothing (e.g. a maintenance page),
+    the previously cached parquet is returned when available and is left untouched.
+    The cache is best effort: if it cannot be written the fetched frame is still returned.
+    """
+    data_path, meta_path = _cache_paths(url)
+    today = datetime.date.today().isoformat()
+
+    meta, cached = {}, None
+    if os.path.exists(data_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        if meta.get('version') == CACHE_VERSION:
+            cached = _read_cached(data_path)
+        if cached is None:
+            # 読めないキャッシュには条件付きリクエストを送らない (304で壊れたままになるため)
+            meta = {}
+        elif meta.get('date') == today:
+            return cached
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
     try:
-        resp = requests.get(url_qbo30)
-        lines = resp.text.splitlines()
-        for line in lines:
-            parts = line.split()
-            if not parts or not parts[0].isdigit(): continue
-            year = int(parts[0])
-            if year < start_year: continue
-            for m in range(1, 13):
-                if m <= len(parts) - 1:
-                    try:
-                        val = float(parts[m])
-                        if val > -900: # specific check for potential missing values
-                             if (year, m) not in data_map: data_map[(year, m)] = {}
-                             data_map[(year, m)]['QBO30'] = val
-                    except: pass
-    except Exception as e:
-        print(f"QBO30 Error: {e}")
+        with session.get(url, headers=headers, timeout=15, stream=True) as resp:
+            if resp.status_code == 304 and cached is not None:
+                df = None
+            else:
+                resp.raise_for_status()
+                # 受信しながら行単位でパースする (全文をメモリに持たない)
+                # 数値表はASCIIなのでデコードせずbytesのまま渡す
+                df = parser(resp.iter_lines())
+                if df.empty:
+                    raise ValueError(f"no data rows parsed from {url}")
+    except Exception:
+        # 一時的な取得失敗やパース失敗ならディスク上の前回分で代用する (キャッシュもmetaも上書きしない)
+        if cached is not None:
+            return cached
+        raise
 
-    # QBO 50hPa
-    url_qbo50 = "https://www.cpc.ncep.noaa.gov/data/indices/qbo.u50.index"
+    new_meta = {
+        'version': CACHE_VERSION,
+        'date': today,
+        'etag': resp.headers.get('ETag', meta.get('etag')),
+        'last_modified': resp.headers.get('Last-Modified', meta.get('last_modified')),
+    }
     try:
-        resp = requests.get(url_qbo50)
-        lines = resp.text.splitlines()
-        for line in lines:
-            parts = line.split()
-            if not parts or not parts[0].isdigit(): continue
-            year = int(parts[0])
-            if year < start_year: continue
-            for m in range(1, 13):
-                if m <= len(parts) - 1:
-                    try:
-                        val = float(parts[m])
-                        if val > -900:
-                            if (year, m) not in data_map: data_map[(year, m)] = {}
-                            data_map[(year, m)]['QBO50'] = val
-                    except: pass
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # parquetを置き換えてからmetaを書く. 途中で失敗しても古いmetaが新しいparquetを指すだけで済む
+        if df is not None:
+            _write_atomic(data_path, lambda f: df.to_parquet(f, index=False))
+        _write_atomic(meta_path, lambda f: f.write(json.dumps(new_meta).encode()))
     except Exception as e:
-        print(f"QBO50 Error: {e}")
+        # 書き込めない環境 (読み取り専用など) でも取得したデータはそのまま使う
+        print(f"Cache write failed for {url}: {e}")
+    return cached if df is None else df
+
+
+# 4桁の年で始まり値が続く行だけをデータ行とみなす (ヘッダ・フッタ・HTMLは読み飛ばす)
+_DATA_LINE = re.compile(rb'[ \t]*\d{4}[ \t]+\S')
+
+
+def parse_monthly_table(lines, name, missing_thresh=None, full_rows=False, keep_last=False):
+    """
+    Parses the (bytes) lines of a "Year + 12 monthly values" text table into a long DataFrame (Year, Month, name).
+    Only lines starting with a 4-digit year are read and short rows are padded with NaN.
+    Values with abs(val) >= missing_thresh are treated as missing.
+    keep_last keeps the last occurrence of a (Year, Month) repeated in later sections of the file.
+    """
+    data = b'\n'.join(line for line in lines if _DATA_LINE.match(line))
+    if data:
+        # pandasのCパーサで空白区切りとして読む. usecolsで年+12ヶ月だけ取るので, 後ろの余分な列 (年平均など)
+        # があっても落ちず, 短い行 (当年分) はNaNで埋まる
+        raw = pd.read_csv(io.BytesIO(data), sep=r'\s+', header=None, engine='c',
+                          names=range(13), usecols=range(13))
+    else:
+        raw = pd.DataFrame(np.empty((0, 13)))
+    if full_rows:
+        raw = raw[raw[12].notna()]
+    # 数値にならないセルを含む列だけNaNに変換する
+    for c in raw.select_dtypes(exclude='number').columns:
+        raw[c] = pd.to_numeric(raw[c], errors='coerce')
+    arr = raw.to_numpy(dtype=np.float64)
+    vals = arr[:, 1:13]
+
+    # 縦持ちへの変換はNumPyで直接行う: 有効な値の (行, 月) を行優先で取り出す
+    keep = ~np.isnan(vals)
+    if missing_thresh is not None:
+        keep &= np.abs(vals) < missing_thresh
+    row_i, month_i = np.nonzero(keep)
+    years = arr[row_i, 0].astype(np.int16)
+    months = (month_i + 1).astype(np.int8)
+    values = vals[keep].astype(np.float32)
+    if keep_last:
+        # 同じ年が複数セクションに出る場合は後に出現した値を優先 (QBOファイル)
+        key = years.astype(np.int32) * 16 + months
+        _, first_rev = np.unique(key[::-1], return_index=True)
+        idx = np.sort(key.size - 1 - first_rev)
+        years, months, values = years[idx], months[idx], values[idx]
+    return pd.DataFrame({'Year': years, 'Month': months, name: values})
+
+
+# 取得元の定義: 列名, URL, 欠損値の閾値 (abs(val) >= missing), 12ヶ月揃った行のみ使うか, <pre>内を読むか,
+# 複数セクションで重複する年月を後勝ちにするか (それ以外のソースでは重複はエラー)
+SOURCES = [
+    # --- 1. ENSO (ONI) - NOAA PSL Text Data ---
+    {'name': 'ONI', 'url': "https://psl.noaa.gov/data/correlation/oni.data",
+     'missing': 90, 'full_rows': True},
+    # --- 2. IOD (DMI) - NOAA PSL Text Data ---
+    {'name': 'IOD', 'url': "https://psl.noaa.gov/gcos_wgsp/Timeseries/Data/dmi.had.long.data",
+     'missing': 90, 'full_rows': True},
+    # --- 3. PDO - NOAA NCEI Text Data ---
+    {'name': 'PDO', 'url': "https://www.ncei.noaa.gov/pub/data/cmb/ersst/v5/index/ersst.v5.pdo.dat",
+     'missing': 90, 'full_rows': True},
+    # --- 4. Nino West (JMA) --- 99.9 is missing
+    {'name': 'NinoWest', 'url': "https://www.data.jma.go.jp/cpd/data/elnino/index/ninowidx.html",
+     'missing': 90, 'html_pre': True},
+    # --- 5-7. NAO / PNA / AO (NOAA CPC) --- standardized, so -99.9/-999 style fills are caught too
+    {'name': 'NAO', 'url': "https://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.nao.monthly.b5001.current.ascii.table",
+     'missing': 90},
+    {'name': 'PNA', 'url': "https://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.pna.monthly.b5001.current.ascii.table",
+     'missing': 90},
+    {'name': 'AO', 'url': "https://www.cpc.ncep.noaa.gov/products/precip/CWlink/daily_ao_index/monthly.ao.index.b50.current.ascii.table",
+     'missing': 90},
+    # --- 8. QBO (NOAA CPC) 30hPa / 50hPa ---
+    # 元データと標準化値の2セクションがあり, 後のセクションを使う
+    {'name': 'QBO30', 'url': "https://www.cpc.ncep.noaa.gov/data/indices/qbo.u30.index",
+     'missing': 900, 'keep_last': True},
+    {'name': 'QBO50', 'url': "https://www.cpc.ncep.noaa.gov/data/indices/qbo.u50.index",
+     'missing': 900, 'keep_last': True},
+]
+
+
+# 指数の列名 (SOURCESの順). 列名はここで一度だけ決め, 以降は走査しない
+INDEX_COLS = [spec['name'] for spec in SOURCES]
+
+
+def _pre_block(lines):
+    """
+    Yields the lines inside the first <pre>...</pre> block.
+    """
+    inside = False
+    for line in lines:
+        if not inside:
+            if b"<pre>" not in line: continue
+            inside = True
+            line = line.split(b"<pre>", 1)[1]
+        if b"</pre>" in line:
+            yield line.split(b"</pre>", 1)[0]
+            return
+        yield line
+
+
+def _parse_source(spec, lines):
+    """
+    Parses the raw lines of one SOURCES entry into a long DataFrame.
+    """
+    if spec.get('html_pre'):
+        # Simple parsing for <pre> block
+        lines = _pre_block(lines)
+    return parse_monthly_table(lines, spec['name'], spec.get('missing'), spec.get('full_rows', False),
+                               spec.get('keep_last', False))
+
+
+def _load(spec, session):
+    """
+    Returns one source indexed by (Year, Month); duplicate keys raise instead of merging silently.
+    """
+    df = fetch_cached(spec['url'], functools.partial(_parse_source, spec), session)
+    df = df.set_index(['Year', 'Month'])
+    if not df.index.is_unique:
+        raise ValueError(f"{spec['name']}: duplicate (Year, Month) rows")
+    return df
+
+
+# Cache data for 24 hours. Not persist="disk": Streamlit ignores ttl for persisted caches,
+# restarts are covered by the per-source parquet cache in fetch_cached instead.
+@st.cache_data(ttl=3600*24, max_entries=4)
+def get_climate_indices(start_year=1950):
+    """
+    Fetches ONI, IOD, PDO and the other indices from NOAA/PSL/JMA text sources.
+    Returns a merged DataFrame (with a Date column for plotting).
+    """
+    # I/O待ちが支配的なので全ソースを並列に取得する
+    frames = []
+    session = _session()
+    with ThreadPoolExecutor(max_workers=len(SOURCES)) as ex:
+        futures = {ex.submit(_load, spec, session): spec['name'] for spec in SOURCES}
+        for future in as_completed(futures):
+            try:
+                frames.append(future.result())
+            except Exception as e:
+                print(f"{futures[future]} Error: {e}")
 
     # --- DataFrame化 ---
-    rows = []
-    for (y, m), vals in data_map.items():
-        row = {'Year': y, 'Month': m}
-        row.update(vals)
-        rows.append(row)
-    
-    df = pd.DataFrame(rows)
+    if not frames:
+        return pd.DataFrame()
+    # (Year, Month) のMultiIndexで揃えて横に連結し, インデックス順に並べる
+    df = pd.concat(frames, axis=1, join='outer').sort_index()
+    # ソート済みなのでstart_year以降はスライスで取れる (マスク+コピー不要)
+    df = df.loc[start_year:].reset_index()
     if not df.empty:
-        df = df.sort_values(['Year', 'Month'])
-        cols = ['Year', 'Month', 'ONI', 'IOD', 'PDO', 'NinoWest', 'NAO', 'PNA', 'AO', 'QBO30', 'QBO50']
-        existing_cols = [c for c in cols if c in df.columns]
-        df = df[existing_cols]
+        existing_cols = [c for c in INDEX_COLS if c in df.columns]
+        df = df[['Year', 'Month'] + existing_cols]
+        # 指数はfloat32、Year/Monthは小さい整数型で十分
+        dtypes = {c: 'float32' for c in existing_cols}
+        dtypes.update(Year='int16', Month='int8')
+        df = df.astype(dtypes)
+        # グラフ用の日付列もキャッシュ内で作っておく
+        df['Date'] = pd.to_datetime(dict(year=df['Year'], month=df['Month'], day=1))
+        # 解決済みの列構成をdfに持たせ, 検索側で毎回INDEX_COLSを走査しないようにする
+        # build_id は検索側の月別分割キャッシュのキー (dfの中身をハッシュしないため)
+        df.attrs.update(index_cols=tuple(existing_cols), pdo='PDO' if 'PDO' in existing_cols else None,
+                        build_id=time.time_ns())
         
     return df
 
+def downsample_minmax(x, y, max_points=1000):
+    """
+    Reduces a series to at most max_points by keeping the min and max of each bin.
+    Series already within the limit are returned unchanged.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    n = len(y)
+    if n <= max_points:
+        return x, y
+
+    # 切り上げたビン幅で末尾をNaNで埋め, 端数も含めて全点をいずれかのビンに入れる (ビン数 <= max_points // 2)
+    size = -(-n // max(max_points // 2, 1))
+    n_bins = -(-n // size)
+    body = np.full(n_bins * size, np.nan)
+    body[:n] = y
+    body = body.reshape(n_bins, size)
+    offsets = np.arange(n_bins) * size
+    lo = np.argmin(np.where(np.isnan(body), np.inf, body), axis=1) + offsets
+    hi = np.argmax(np.where(np.isnan(body), -np.inf, body), axis=1) + offsets
+    idx = np.unique(np.concatenate([lo, hi]))
+    idx = idx[idx < n]
+    return x[idx], y[idx]
+
+# PDO位相 -> カーネルに渡す整数コード ('any' などは 0 = 条件なし)
+PDO_MODES = {'pos': 1, 'neg': 2, '0': 3}
+
+
+def _analog_numpy(vals, req_pos, tgt_pos, tv, pdo_pos, pdo_mode, th, k):
+    """
+    Filters rows of vals (NaN in req_pos columns, PDO phase) and returns the k best
+    (rows, scores) by Euclidean distance to tv, best first; ties keep row order.
+    """
+    mask = ~np.isnan(vals[:, req_pos]).any(axis=1)
+    if pdo_pos >= 0:
+        pdo = vals[:, pdo_pos]
+        if pdo_mode == 1:
+            mask &= pdo >= th
+        elif pdo_mode == 2:
+            mask &= pdo <= -th
+        elif pdo_mode == 3:
+            mask &= (pdo > -th) & (pdo < th)
+
+    rows = np.flatnonzero(mask)
+    # カーネルと同じくfloat32で列順に足し込む (スコアと同点の判定を両経路で一致させる)
+    acc = np.zeros(rows.size, np.float32)
+    for j, c in enumerate(tgt_pos):
+        d = vals[rows, c] - tv[j]
+        acc += d * d
+    scores = np.sqrt(acc)
+
+    # 上位k件だけ部分選択してからソートする. k番目のスコア以下を全て候補に残すので,
+    # 境界で同点があっても年の古い順 (行順) が保たれる
+    k = max(k, 0)
+    if k == 0 or k >= scores.size:
+        idx = np.argsort(scores, kind='stable')[:k]
+    else:
+        kth = np.partition(scores, k - 1)[k - 1]
+        cand = np.flatnonzero(scores <= kth)
+        idx = cand[np.argsort(scores[cand], kind='stable')][:k]
+    return rows[idx], scores[idx]
+
+
+if njit is not None:
+    # No fastmath: it would drop the NaN checks and make tie-breaking depend on FMA contraction
+    @njit(cache=True)
+    def _analog_kernel(vals, req_pos, tgt_pos, tv, pdo_pos, pdo_mode, th, k):
+        # (score, row) の最大ヒープに上位k件を保持しながら1パスで走査する
+        heap_s = np.empty(max(k, 0), np.float32)
+        heap_r = np.empty(max(k, 0), np.int64)
+        size = 0
+        if k <= 0:
+            return heap_s, heap_r
+
+        for i in range(vals.shape[0]):
+            ok = True
+            for c in req_pos:
+                if np.isnan(vals[i, c]):
+                    ok = False
+                    break
+            if not ok:
+                continue
+            if pdo_pos >= 0:
+                p = vals[i, pdo_pos]
+                if pdo_mode == 1 and not p >= th:
+                    continue
+                if pdo_mode == 2 and not p <= -th:
+                    continue
+                if pdo_mode == 3 and not (p > -th and p < th):
+                    continue
+
+            acc = np.float32(0.0)
+            for j in range(tgt_pos.size):
+                d = vals[i, tgt_pos[j]] - tv[j]
+                acc += d * d
+            s = np.sqrt(acc)
+
+            if size < k:
+                # sift up (行番号は常に既存より大きいので同点なら親の方が小さい)
+                pos = size
+                size += 1
+                while pos > 0:
+                    parent = (pos - 1) // 2
+                    if heap_s[parent] > s:
+                        break
+                    heap_s[pos] = heap_s[parent]
+                    heap_r[pos] = heap_r[parent]
+                    pos = parent
+                heap_s[pos] = s
+                heap_r[pos] = i
+            elif s < heap_s[0]:
+                # replace the worst and sift down
+                pos = 0
+                while True:
+                    child = 2 * pos + 1
+                    if child >= size:
+                        break
+                    right = child + 1
+                    if right < size and (heap_s[right] > heap_s[child] or
+                                         (heap_s[right] == heap_s[child] and heap_r[right] > heap_r[child])):
+                        child = right
+                    if heap_s[child] < s or (heap_s[child] == s and heap_r[child] < i):
+                        break
+                    heap_s[pos] = heap_s[child]
+                    heap_r[pos] = heap_r[child]
+                    pos = child
+                heap_s[pos] = s
+                heap_r[pos] = i
+        return heap_s[:size], heap_r[:size]
+
+    def _analog(vals, req_pos, tgt_pos, tv, pdo_pos, pdo_mode, th, k):
+        scores, rows = _analog_kernel(vals, req_pos, tgt_pos, tv, pdo_pos, pdo_mode, th, k)
+        order = np.lexsort((rows, scores))
+        return rows[order], scores[order]
+
+    # Warm up at import so the first search does not pay the JIT (or cache load) cost
+    _analog(np.zeros((2, 2), np.float32), np.array([0, 1]), np.array([0]),
+            np.zeros(1, np.float32), 1, 1, np.float32(0.5), 1)
+else:
+    _analog = _analog_numpy
+
+
+def _split_by_month(df):
+    """
+    Splits df by month into (sub-frame, C-contiguous float32 matrix of the index columns).
+    Returns ({column: matrix position}, {month: (frame, values)}).
+    """
+    value_cols = list(df.attrs.get('index_cols') or [c for c in INDEX_COLS if c in df.columns])
+    col_pos = {c: j for j, c in enumerate(value_cols)}
+    months = {
+        m: (g, np.ascontiguousarray(g[value_cols].to_numpy(dtype=np.float32)))
+        for m, g in df.groupby('Month', sort=False)
+    }
+    return col_pos, months
+
+
+@st.cache_resource(max_entries=4)
+def _cached_split(_df, key):
+    """
+    _split_by_month cached by key only; _df is not hashed by Streamlit.
+    """
+    return _split_by_month(_df)
+
+
+def _by_month(df):
+    """
+    Returns the month split of df, reusing it for frames from get_climate_indices.
+    The result may be shared and must not be mutated.
+    """
+    build_id = df.attrs.get('build_id')
+    if build_id is None:
+        return _split_by_month(df)
+    # attrsは派生したdfにも引き継がれるので, 行の抜き出しなどで形が変わったら別キーにする
+    return _cached_split(df, (build_id, df.shape))
+
+
 def search_analog_years(
     df, 
     target_month, 
@@ -230,47 +481,39 @@ def search_analog_years(
     targets: dict of {column_name: target_value} to be used for distance calculation.
     """
     # 2. フィルタリング (月)
-    candidates = df[df['Month'] == target_month].copy()
-    
-    # 3. フィルタリング & NaN除去
-    # 必要なカラム(ターゲットになっているもの + PDO)が揃っている行だけ残す
-    # PDO位相チェックが有効ならPDOも必須
-    required_cols = list(targets.keys())
-    if 'PDO' in df.columns:
-        required_cols.append('PDO') # PDO is always used for filtering if present
+    # 月別に分割済みの行列をスライスするだけ (共有オブジェクトなので書き換えないこと)
+    col_pos, months = _by_month(df)
+    frame, vals = months.get(target_month, (df.iloc[:0], np.empty((0, len(col_pos)), np.float32)))
 
     # Check if required columns exist in df
-    valid_targets = {k: v for k, v in targets.items() if k in df.columns}
+    valid_targets = {k: v for k, v in targets.items() if k in col_pos}
     if not valid_targets:
         return pd.DataFrame()
-        
-    candidates = candidates.dropna(subset=[c for c in required_cols if c in candidates.columns])
     
-    if 'PDO' in candidates.columns:
-        if pdo_phase == 'pos':
-            candidates = candidates[candidates['PDO'] >= pdo_threshold]
-        elif pdo_phase == 'neg':
-            candidates = candidates[candidates['PDO'] <= -pdo_threshold]
-        elif pdo_phase == '0':
-            candidates = candidates[
-                (candidates['PDO'] > -pdo_threshold) & 
-                (candidates['PDO'] < pdo_threshold)
-            ]
-    
-    if candidates.empty:
-        return pd.DataFrame()
-
-    # 4. 類似度スコア計算 (ユークリッド距離)
+    # 3. フィルタリング & NaN除去 + 4. 類似度スコア計算 (ユークリッド距離) + 5. 上位top_n件
+    # 必要なカラム(ターゲットになっているもの + PDO)が揃っている行だけ残す
     # distance = sqrt( sum( (val - target)^2 ) )
-    
-    # Calculate diffs for display and score
-    sq_diff_sum = 0
-    for col, target_val in valid_targets.items():
-        candidates[f'{col}_Diff'] = candidates[col] - target_val
-        sq_diff_sum += candidates[f'{col}_Diff'] ** 2
-        
-    candidates['Score'] = np.sqrt(sq_diff_sum)
+    cols = list(valid_targets)
+    required_cols = list(cols)
+    pdo_col = df.attrs.get('pdo', 'PDO')
+    if pdo_col in col_pos:
+        required_cols.append(pdo_col) # PDO is always used for filtering if present
+
+    req_pos = np.array([col_pos[c] for c in required_cols])
+    tgt_pos = np.array([col_pos[c] for c in cols])
+    tv = np.array([valid_targets[c] for c in cols], dtype=np.float32)
+
+    rows, scores = _analog(
+        vals, req_pos, tgt_pos, tv,
+        col_pos.get(pdo_col, -1), PDO_MODES.get(pdo_phase, 0), np.float32(pdo_threshold), top_n,
+    )
+    if rows.size == 0:
+        return pd.DataFrame()
 
-    # 5. ソートして返す
-    results = candidates.sort_values('Score').head(top_n)
+    # 差分とスコアは選ばれた行にだけ付ける
+    D = vals[np.ix_(rows, tgt_pos)] - tv
+    results = frame.iloc[rows].assign(
+        **{f'{c}_Diff': D[:, j] for j, c in enumerate(cols)},
+        Score=scores,
+    )
     return results
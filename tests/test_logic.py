@@ -0,0 +1,235 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import logic
+
+
+def test_sentinel_becomes_nan_and_is_dropped():
+    lines = [b"1950 -1.5 -999.9 -1.2 -1.0 -0.8 -0.6 -0.5 -0.4 -0.4 -0.5 -0.6 -0.8"]
+    df = logic.parse_monthly_table(lines, 'PDO', missing_thresh=90)
+    assert 2 not in df['Month'].tolist()
+    assert len(df) == 11
+    assert not df['PDO'].isna().any()
+
+
+def test_empty_input():
+    df = logic.parse_monthly_table([], 'NAO', missing_thresh=90)
+    assert df.empty
+    assert list(df.columns) == ['Year', 'Month', 'NAO']
+    assert df['NAO'].dtype == np.float32
+
+
+def test_partial_year_and_headers():
+    lines = [
+        b" Year  Jan  Feb  Mar",
+        b"1950 1 2 3 4 5 6 7 8 9 10 11 12",
+        b"1951 0.5 0.25",
+        b"  ONI from CPC",
+    ]
+    df = logic.parse_monthly_table(lines, 'ONI', missing_thresh=90)
+    assert df.groupby('Year').size().to_dict() == {1950: 12, 1951: 2}
+    assert df.loc[df['Year'] == 1951, 'ONI'].tolist() == [0.5, 0.25]
+
+    full = logic.parse_monthly_table(lines, 'ONI', missing_thresh=90, full_rows=True)
+    assert full['Year'].unique().tolist() == [1950]
+
+
+def test_extra_columns_are_ignored():
+    wide = b"1951 " + b" ".join([b"1"] * 25)
+    df = logic.parse_monthly_table([b"1950 1 2", wide], 'AO', missing_thresh=90)
+    assert df.groupby('Year').size().to_dict() == {1950: 2, 1951: 12}
+
+
+def _analog_both(vals, req_pos, tgt_pos, tv, pdo_pos=-1, pdo_mode=0, th=0.5, k=5):
+    args = (np.asarray(vals, np.float32), np.asarray(req_pos), np.asarray(tgt_pos),
+            np.asarray(tv, np.float32), pdo_pos, pdo_mode, np.float32(th), k)
+    fused = logic._analog(*args)
+    numpy_ = logic._analog_numpy(*args)
+    np.testing.assert_array_equal(fused[0], numpy_[0])
+    np.testing.assert_array_equal(fused[1], numpy_[1])
+    return fused
+
+
+def test_analog_matches_numpy_on_rounded_data():
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        n = int(rng.integers(0, 80))
+        vals = np.round(rng.normal(0, 1, (n, 4)), 1)
+        vals[rng.random((n, 4)) < 0.05] = np.nan
+        tgt = rng.choice(3, int(rng.integers(1, 4)), replace=False)
+        tv = np.round(rng.normal(0, 1, tgt.size), 1)
+        _analog_both(vals, np.append(tgt, 3), tgt, tv, 3, int(rng.integers(0, 4)),
+                     rng.choice([0.0, 0.5]), int(rng.integers(0, 25)))
+
+
+def test_analog_ties_at_cutoff_keep_row_order():
+    # rows 2, 5 and 8 all score 1.0; only two of them fit after row 0
+    vals = [[0.0], [3.0], [1.0], [2.0], [4.0], [-1.0], [5.0], [6.0], [1.0]]
+    rows, scores = _analog_both(vals, [0], [0], [0.0], k=3)
+    assert rows.tolist() == [0, 2, 5]
+    assert scores.tolist() == [0.0, 1.0, 1.0]
+
+
+def test_analog_k_bounds():
+    vals = [[0.5], [np.nan], [0.1]]
+    rows, _ = _analog_both(vals, [0], [0], [0.0], k=10)
+    assert rows.tolist() == [2, 0]
+    rows, scores = _analog_both(vals, [0], [0], [0.0], k=0)
+    assert rows.size == 0 and scores.size == 0
+
+
+@pytest.mark.parametrize('phase, expected', [
+    ('pos', [0, 1]), ('neg', [3, 4]), ('0', [2]), ('any', [0, 1, 2, 3, 4]),
+])
+def test_analog_pdo_modes(phase, expected):
+    # column 0 is the target, column 1 PDO; every row scores 0 so order is row order
+    vals = [[0.0, 1.0], [0.0, 0.5], [0.0, 0.0], [0.0, -0.5], [0.0, -1.0]]
+    rows, _ = _analog_both(vals, [0, 1], [0], [0.0], 1, logic.PDO_MODES.get(phase, 0), 0.5, k=10)
+    assert rows.tolist() == expected
+
+
+def test_search_analog_years():
+    df = pd.DataFrame({
+        'Year': np.repeat(np.arange(2000, 2004), 2).astype(np.int16),
+        'Month': np.tile([1, 2], 4).astype(np.int8),
+        'ONI': np.array([-0.5, 0, -1.0, 0, -0.4, 0, 0.8, 0], np.float32),
+        'IOD': np.array([0.0, 0, 0.2, 0, np.nan, 0, 0.0, 0], np.float32),
+        'PDO': np.array([-1.0, 0, -0.8, 0, -0.9, 0, -1.2, 0], np.float32),
+    })
+    res = logic.search_analog_years(df, 1, {'ONI': -0.5, 'IOD': 0.0, 'NAO': 1.0}, 'neg', 0.5, top_n=5)
+    # 2002 has no IOD, NAO is not a column
+    assert res['Year'].tolist() == [2000, 2001, 2003]
+    np.testing.assert_allclose(res['Score'], [0.0, np.hypot(0.5, 0.2), 1.3], rtol=1e-6)
+    np.testing.assert_allclose(res['ONI_Diff'], [0.0, -0.5, 1.3], rtol=1e-6)
+    assert 'NAO_Diff' not in res.columns
+
+    assert logic.search_analog_years(df, 1, {'ONI': 0.0}, 'pos', 0.5).empty
+    assert logic.search_analog_years(df, 1, {'NAO': 0.0}).empty
+
+
+class _StubResponse:
+    def __init__(self, status_code=200, lines=(), fail_after=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._lines = list(lines)
+        self._fail_after = fail_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise logic.requests.HTTPError(self.status_code)
+
+    def iter_lines(self):
+        for i, line in enumerate(self._lines):
+            if i == self._fail_after:
+                raise logic.requests.ConnectionError('connection reset')
+            yield line
+
+
+class _StubSession:
+    def __init__(self, response):
+        self.response = response
+        self.calls = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.calls.append(dict(headers or {}))
+        return self.response
+
+
+_TABLE = [b"1950 1 2 3 4 5 6 7 8 9 10 11 12", b"1951 0.5 0.25"]
+
+
+def _parse_oni(lines):
+    return logic.parse_monthly_table(lines, 'ONI', missing_thresh=90)
+
+
+@pytest.fixture
+def seeded_cache(tmp_path, monkeypatch):
+    """Cache holding one good fetch, dated yesterday so the next call sends a request."""
+    monkeypatch.setattr(logic, 'CACHE_DIR', str(tmp_path))
+    url = 'https://example.test/oni.data'
+    good = logic.fetch_cached(url, _parse_oni, _StubSession(_StubResponse(lines=_TABLE, headers={'ETag': '"v1"'})))
+    data_path, meta_path = logic._cache_paths(url)
+    with open(meta_path) as f:
+        meta = logic.json.load(f)
+    meta['date'] = '2000-01-01'
+    with open(meta_path, 'w') as f:
+        logic.json.dump(meta, f)
+    return url, good, data_path, meta_path
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('response', [
+    _StubResponse(lines=[b"<html><body>Down for maintenance</body></html>"]),
+    _StubResponse(lines=_TABLE + [b"1952 1 2 3"], fail_after=2),
+    _StubResponse(status_code=503),
+], ids=['empty-parse', 'error-mid-stream', 'http-error'])
+def test_fetch_cached_keeps_cache_on_bad_response(seeded_cache, response):
+    url, good, data_path, meta_path = seeded_cache
+    data_before, meta_before = _read_bytes(data_path), _read_bytes(meta_path)
+
+    session = _StubSession(response)
+    df = logic.fetch_cached(url, _parse_oni, session)
+
+    pd.testing.assert_frame_equal(df, good)
+    assert session.calls == [{'If-None-Match': '"v1"'}]
+    assert _read_bytes(data_path) == data_before
+    assert _read_bytes(meta_path) == meta_before
+
+
+def test_fetch_cached_not_modified(seeded_cache):
+    url, good, data_path, meta_path = seeded_cache
+    data_before = _read_bytes(data_path)
+    with open(meta_path) as f:
+        meta_before = logic.json.load(f)
+
+    df = logic.fetch_cached(url, _parse_oni, _StubSession(_StubResponse(status_code=304)))
+
+    pd.testing.assert_frame_equal(df, good)
+    assert _read_bytes(data_path) == data_before
+    with open(meta_path) as f:
+        meta_after = logic.json.load(f)
+    # 304 only refreshes the date (same-day skip); validators are kept
+    assert meta_after.pop('date') == logic.datetime.date.today().isoformat()
+    meta_before.pop('date')
+    assert meta_after == meta_before
+
+
+@pytest.mark.parametrize('nan_frac', [0.0, 0.05])
+@pytest.mark.parametrize('n', [1001, 1999, 2000, 10_000])
+def test_downsample_minmax_caps_points(n, nan_frac):
+    rng = np.random.default_rng(n)
+    x = np.arange(n)
+    y = rng.normal(size=n)
+    y[rng.random(n) < nan_frac] = np.nan
+
+    out_x, out_y = logic.downsample_minmax(x, y, max_points=1000)
+
+    assert len(out_x) == len(out_y) <= 1000
+    assert np.all(np.diff(out_x) > 0)
+    np.testing.assert_array_equal(out_y, y[out_x])
+    # every bin keeps its min and max
+    size = -(-n // 500)
+    for start in range(0, n, size):
+        seg = y[start:start + size]
+        if np.isnan(seg).all():
+            continue
+        kept = out_y[(out_x >= start) & (out_x < start + size)]
+        assert np.nanmin(seg) in kept and np.nanmax(seg) in kept
+
+
+def test_downsample_minmax_short_series_unchanged():
+    x, y = np.arange(10), np.linspace(0, 1, 10)
+    out_x, out_y = logic.downsample_minmax(x, y, max_points=1000)
+    np.testing.assert_array_equal(out_x, x)
+    np.testing.assert_array_equal(out_y, y)